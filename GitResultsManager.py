@@ -21,16 +21,28 @@ import sys
 import logging
 import stat
 import subprocess
+import select
 import datetime
 import time
 import errno
 import signal
 import threading
 import fcntl
+import array
+import atexit
+import re
+import hashlib
+import collections
+import shutil
+import socket
+import tempfile
+import json
+import SocketServer
+import termios
 from threading import Semaphore
 import pdb
 
-__all__ = [ 'GitResultsManager', 'resman' ]
+__all__ = [ 'GitResultsManager', 'resman', 'logMetric', 'loadMetrics' ]
 
 
 
@@ -79,8 +91,177 @@ class OutstreamHandler(object):
 
 
 
+class ProgressCollapser(object):
+    '''Splits output into diary lines, collapsing lines that are
+    rewritten in place with carriage returns (progress bars from tqdm
+    and similar). Such a line is recorded in its final state only or,
+    if sampleInterval is given, also at most once every sampleInterval
+    seconds while it is being rewritten. Overwritten text is dropped as
+    it arrives, so the work is linear in the amount of output.'''
+
+    def __init__(self, sampleInterval = None):
+        self.sampleInterval = sampleInterval
+        self.reset()
+
+    def reset(self):
+        self._pending = []        # chunks of the current, unterminated line
+        self._pendingCR = False   # it ended in '\r', which may be the start of '\r\n'
+        self.progress = False     # it has been rewritten with '\r'
+        self._lastSample = None
+
+    def feed(self, data):
+        '''Add output, return the list of diary lines it completes.'''
+        lines = []
+        for ii, piece in enumerate(data.split('\n')):
+            if ii > 0:
+                lines.append(''.join(self._pending))
+                self.reset()
+            if not piece:
+                continue
+            if self._pendingCR:
+                # Not followed by '\n', so the line is being rewritten
+                self._overwrite(lines)
+            stripped = piece.rstrip('\r')
+            self._pendingCR = len(stripped) < len(piece)
+            idx = stripped.rfind('\r')
+            if idx >= 0:
+                self._overwrite(lines)
+                stripped = stripped[idx + 1:]
+            if stripped:
+                self._pending.append(stripped)
+        return lines
+
+    def isEmpty(self):
+        return not (self._pending or self.progress)
+
+    def takePartial(self, includeProgress = True):
+        '''Return the unterminated line (None if there is none) and
+        start a new one. A line being rewritten, or ending in a '\r'
+        that may yet turn out to be part of '\r\n', is only returned
+        with includeProgress, as it will usually change again.'''
+        if self.isEmpty() or ((self.progress or self._pendingCR) and not includeProgress):
+            return None
+        line = ''.join(self._pending)
+        self.reset()
+        return line
+
+    def _overwrite(self, lines):
+        now = time.time()
+        if self.sampleInterval is not None and self.progress and now - self._lastSample >= self.sampleInterval:
+            lines.append(''.join(self._pending))
+            self._lastSample = now
+        elif not self.progress:
+            self._lastSample = now
+        self.progress = True
+        self._pending = []
+        self._pendingCR = False
+
+
+
+class LineSuppressor(object):
+    '''Thins out the diary lines of one stream. Runs of identical lines,
+    or with normalizeNumbers lines that only differ in their numbers,
+    are folded into a "last line repeated N times" record (reported at
+    least every REPEAT_REPORT_INTERVAL seconds while the run lasts).
+    With maxRate, lines beyond maxRate per second (allowing bursts of
+    one second's worth) are dropped and their number recorded; repeats
+    are folded first, so a run of repeats costs a single line of the
+    budget. nFolded and nDropped count all lines left out.'''
+
+    REPEAT_REPORT_INTERVAL = 30
+    _numberRe = re.compile(r'[0-9]+(\.[0-9]*)?([eE][-+]?[0-9]+)?')
+
+    def __init__(self, foldRepeats = True, normalizeNumbers = False, maxRate = None):
+        self.foldRepeats = foldRepeats or normalizeNumbers
+        self.normalizeNumbers = normalizeNumbers
+        self.maxRate = maxRate
+        self.nFolded = 0
+        self.nDropped = 0
+        self._lastKey = None
+        self._lastDropped = None    # text of the last line, if it was dropped
+        self._repeats = 0
+        self._repeatSince = None
+        self._pendingDrops = 0
+        self._tokens = max(1.0, maxRate or 0)
+        self._tokenTime = None
+
+    def filter(self, lines):
+        '''Return the lines (and records of left out lines) to log.'''
+        now = time.time()
+        out = []
+        for line in lines:
+            if self.foldRepeats:
+                key = self._numberRe.sub('#', line) if self.normalizeNumbers else line
+                if key == self._lastKey:
+                    self._repeats += 1
+                    self.nFolded += 1
+                    if self._repeatSince is None:
+                        self._repeatSince = now
+                    elif now - self._repeatSince >= self.REPEAT_REPORT_INTERVAL:
+                        out.extend(self._repeatRecord())
+                    continue
+                out.extend(self._repeatRecord())
+                self._lastKey = key
+            if self.maxRate is not None and not self._takeToken(now):
+                self._pendingDrops += 1
+                self.nDropped += 1
+                self._lastDropped = line
+                continue
+            self._lastDropped = None
+            out.extend(self._dropRecord())
+            out.append(line)
+        return out
+
+    def finish(self):
+        '''Return the records of lines left out that are not yet logged.'''
+        return self._repeatRecord() + self._dropRecord()
+
+    def _repeatRecord(self):
+        if not self._repeats:
+            return []
+        if self._lastDropped is None:
+            record = '[last line repeated %d times]' % self._repeats
+        else:
+            # The line itself was dropped, so say which one it was
+            record = '[line repeated %d times: %s]' % (self._repeats, self._lastDropped)
+        self._repeats = 0
+        self._repeatSince = None
+        return [record]
+
+    def _dropRecord(self):
+        if not self._pendingDrops:
+            return []
+        record = '[%d lines dropped, over %g lines per second]' % (self._pendingDrops, self.maxRate)
+        self._pendingDrops = 0
+        return [record]
+
+    def _takeToken(self, now):
+        if self._tokenTime is not None:
+            self._tokens = min(max(1.0, self.maxRate), self._tokens + (now - self._tokenTime) * self.maxRate)
+        self._tokenTime = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+
+
 class OutputLogger(object):
-    '''A logging utility to override sys.stdout'''
+    '''A logging utility to override sys.stdout
+
+    With workerSafe, the diary is written with one O_APPEND write per
+    flush instead of through logging, so that processes forked after
+    startCapture() (e.g. multiprocessing workers) can share it without
+    tearing or duplicating lines. Lines from such processes are tagged
+    with their pid.
+
+    Lines rewritten with carriage returns (progress bars) are collapsed
+    to their final state in the diary, plus one sample every
+    progressInterval seconds if that is given; see ProgressCollapser.
+
+    With foldRepeats, normalizeNumbers or maxLineRate, repeated lines
+    and lines over the rate limit are left out of the diary (but not
+    the terminal) and accounted for; see LineSuppressor.'''
 
     '''Buffer states'''
     class BState:
@@ -88,22 +269,33 @@ class OutputLogger(object):
         STDOUT = 1
         STDERR = 2
             
-    def __init__(self, filename):
+    def __init__(self, filename, workerSafe = False, progressInterval = None,
+                 foldRepeats = False, normalizeNumbers = False, maxLineRate = None):
         self.stdout = sys.stdout
         self.stderr = sys.stderr
-        self.log = logging.getLogger('autologger')
-        self.log.propagate = False
-        self.log.setLevel(logging.DEBUG)
-        self.fileHandler = logging.FileHandler(filename)
-        formatter = logging.Formatter('%(asctime)s.%(msecs)03d %(message)s', datefmt='%y.%m.%d.%H.%M.%S')
-        self.fileHandler.setFormatter(formatter)
-        self.log.addHandler(self.fileHandler)
+        self.workerSafe = workerSafe
+        if self.workerSafe:
+            self.diaryFd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+            self.fileHandler = None
+        else:
+            self.log = logging.getLogger('autologger')
+            self.log.propagate = False
+            self.log.setLevel(logging.DEBUG)
+            self.fileHandler = logging.FileHandler(filename)
+            formatter = logging.Formatter('%(asctime)s.%(msecs)03d %(message)s', datefmt='%y.%m.%d.%H.%M.%S')
+            self.fileHandler.setFormatter(formatter)
+            self.log.addHandler(self.fileHandler)
+        self.ownerPid = self.bufferPid = os.getpid()
 
         self.stdOutHandler = OutstreamHandler(self.handleWriteOut,
                                               self.handleFlushOut)
         self.stdErrHandler = OutstreamHandler(self.handleWriteErr,
                                               self.handleFlushErr)
-        self.buffer = ''
+        self.lines = []
+        self.collapser = ProgressCollapser(progressInterval)
+        self._suppressArgs = (foldRepeats, normalizeNumbers, maxLineRate)
+        self.suppressors = self._makeSuppressors()
+        self.suppressing = False
         self.bufferState = self.BState.EMPTY
         self.started = False
 
@@ -120,8 +312,11 @@ class OutputLogger(object):
             raise Exception('ERROR: OutputLogger capture was not started.')
         self.started = False
         self.flush()
+        self._finishDiary()
         sys.stdout = self.stdout
         sys.stderr = self.stderr
+        if self.workerSafe:
+            os.close(self.diaryFd)
 
     def handleWriteOut(self, message):
         self.write(message, self.BState.STDOUT)
@@ -136,43 +331,573 @@ class OutputLogger(object):
         self.flush()
         
     def write(self, message, destination):
-        if destination == self.BState.STDOUT:
-            self.stdout.write(message)
-        else:
-            self.stderr.write(message)
-        
-        if destination == self.bufferState or self.bufferState == self.BState.EMPTY:
-            self.buffer += message
-            self.bufferState = destination
-        else:
+        stream = self.stdout if destination == self.BState.STDOUT else self.stderr
+        stream.write(message)
+        if '\r' in message:
+            # Keep progress bars live on a line buffered terminal
+            stream.flush()
+        self.record(message, destination)
+
+    def record(self, message, destination):
+        '''Add message to the diary buffer without echoing it.'''
+        self._checkFork()
+        if destination != self.bufferState and self.bufferState != self.BState.EMPTY:
             # flush and change buffer
-            self.flush()
-            assert(self.buffer == '')
-            self.bufferState = destination
-            self.buffer = '' + message
-        if '\n' in self.buffer:
-            self.flush()
+            self.logBuffer(final = True)
+        self.bufferState = destination
+        self.lines.extend(self.collapser.feed(message))
+        if self.lines:
+            self.logBuffer(linesOnly = True)
 
     def flush(self):
         self.stdout.flush()
         self.stderr.flush()
+        self.logBuffer()
+
+    def logBuffer(self, final = False, linesOnly = False):
+        '''Write any buffered output to the diary. An unterminated line
+        is kept back if linesOnly is True and, if it is a progress bar
+        still being rewritten, unless final is True.'''
+        self._checkFork()
         if self.bufferState != self.BState.EMPTY:
-            if len(self.buffer) > 0 and self.buffer[-1] == '\n':
-                self.buffer = self.buffer[:-1]
-            if self.bufferState == self.BState.STDOUT:
-                for line in self.buffer.split('\n'):
-                    self.log.info('  ' + line)
-            elif self.bufferState == self.BState.STDERR:
-                for line in self.buffer.split('\n'):
-                    self.log.info('* ' + line)
-            self.buffer = ''
+            partial = None if linesOnly else self.collapser.takePartial(includeProgress = final)
+            if partial is not None:
+                self.lines.append(partial)
+            lines = self.lines
+            if self.suppressing:
+                lines = self.suppressors[self.bufferState].filter(lines)
+            self._logLines(self.bufferState, lines)
+            self.lines = []
+            if self.collapser.isEmpty():
+                self.bufferState = self.BState.EMPTY
+        if self.fileHandler:
+            self.fileHandler.flush()
+
+    def _logLines(self, destination, lines):
+        prefix = '  ' if destination == self.BState.STDOUT else '* '
+        if self.workerSafe:
+            if lines:
+                self._appendLines(prefix, lines)
+        else:
+            for line in lines:
+                self.log.info(prefix + line)
+
+    def _makeSuppressors(self):
+        foldRepeats, normalizeNumbers, maxLineRate = self._suppressArgs
+        if not (foldRepeats or normalizeNumbers or maxLineRate):
+            return None
+        return dict((destination, LineSuppressor(foldRepeats, normalizeNumbers, maxLineRate))
+                    for destination in (self.BState.STDOUT, self.BState.STDERR))
+
+    def startSuppressing(self):
+        '''Start passing diary lines through the suppressors, if any.
+        Called once the header of the run has been logged.'''
+        self.suppressing = self.suppressors is not None
+
+    def stopSuppressing(self):
+        '''Stop suppressing and log the records of lines left out and a
+        summary, so that e.g. the footer of the run always gets logged.'''
+        if not self.suppressing:
+            return
+        self.suppressing = False
+        summary = []
+        for destination, name in ((self.BState.STDOUT, 'stdout'), (self.BState.STDERR, 'stderr')):
+            suppressor = self.suppressors[destination]
+            self._logLines(destination, suppressor.finish())
+            if suppressor.nFolded or suppressor.nDropped:
+                summary.append('%s: %d repeated lines folded, %d lines dropped by rate limit'
+                               % (name, suppressor.nFolded, suppressor.nDropped))
+        if summary:
+            self._logLines(self.BState.STDOUT, ['Diary left out lines of ' + '; '.join(summary)])
+        if self.fileHandler:
+            self.fileHandler.flush()
+
+    def _finishDiary(self):
+        '''Log what is left at the end of capture.'''
+        self.logBuffer(final = True)
+        self.stopSuppressing()
+
+    def _checkFork(self):
+        if self.workerSafe and os.getpid() != self.bufferPid:
+            # We are a forked worker; the inherited partial line is the parent's to log
+            self.lines = []
+            self.collapser.reset()
+            self.suppressors = self._makeSuppressors()
             self.bufferState = self.BState.EMPTY
-        self.fileHandler.flush()
+            self.bufferPid = os.getpid()
+
+    def _appendLines(self, prefix, lines):
+        now = time.time()
+        stamp = time.strftime('%y.%m.%d.%H.%M.%S', time.localtime(now)) + '.%03d' % (int(now * 1000) % 1000)
+        if os.getpid() != self.ownerPid:
+            prefix += '[%d] ' % os.getpid()
+        writeAll(self.diaryFd, ''.join('%s %s%s\n' % (stamp, prefix, line) for line in lines))
+
+
+
+class FdOutputLogger(OutputLogger):
+    '''An OutputLogger that captures at the file descriptor level.
+
+    File descriptors 1 and 2 are redirected into pipes with os.dup2, so
+    output from C extensions, subprocesses and os.write() is captured
+    along with Python prints. A reader thread drains the pipes in large
+    chunks, tees them to the original stdout and stderr and feeds the
+    diary.'''
+
+    def __init__(self, filename, workerSafe = False, progressInterval = None,
+                 foldRepeats = False, normalizeNumbers = False, maxLineRate = None):
+        super(FdOutputLogger, self).__init__(filename, workerSafe, progressInterval,
+                                             foldRepeats, normalizeNumbers, maxLineRate)
+        self._savedFds = None
+        self._pipes = None
+        self._thread = None
+        self._readLock = threading.Lock()
+
+    def startCapture(self):
+        if self.started:
+            raise Exception('ERROR: OutputLogger capture was already started.')
+        self.started = True
+        self.stdout.flush()
+        self.stderr.flush()
+        self._savedFds = (os.dup(1), os.dup(2))
+        self._pipes = (os.pipe(), os.pipe())
+        self._wakeup = os.pipe()
+        os.dup2(self._pipes[0][1], 1)
+        os.dup2(self._pipes[1][1], 2)
+        # Python file objects on the redirected fds. stdout would
+        # otherwise switch to block buffering now that it is a pipe.
+        sys.stdout = os.fdopen(os.dup(1), 'w', 1)
+        sys.stderr = os.fdopen(os.dup(2), 'w', 0)
+        self._thread = threading.Thread(name = 'fd-capture-thread', target = self._reader)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def finishCapture(self):
+        if not self.started:
+            raise Exception('ERROR: OutputLogger capture was not started.')
+        self.started = False
+        sys.stdout.flush()
+        sys.stderr.flush()
+        flushCStdio()
+        capturedStdout, capturedStderr = sys.stdout, sys.stderr
+        sys.stdout = self.stdout
+        sys.stderr = self.stderr
+        capturedStdout.close()
+        capturedStderr.close()
+        os.dup2(self._savedFds[0], 1)
+        os.dup2(self._savedFds[1], 2)
+        for rr, ww in self._pipes:
+            os.close(ww)
+        # Subprocesses may still hold the pipes open, so rather than
+        # waiting for EOF ask the reader to drain what is there and quit.
+        os.write(self._wakeup[1], 'x')
+        self._thread.join()
+        for fd in [rr for rr, ww in self._pipes] + list(self._wakeup) + list(self._savedFds):
+            os.close(fd)
+        self._thread = self._pipes = self._savedFds = None
+        self._finishDiary()
+
+    def _reader(self):
+        sources = {self._pipes[0][0]: (self._savedFds[0], self.BState.STDOUT),
+                   self._pipes[1][0]: (self._savedFds[1], self.BState.STDERR)}
+        watched = sources.keys() + [self._wakeup[0]]
+        finishing = False
+        while sources:
+            if finishing:
+                for fd in sources:
+                    makeAsync(fd)
+                ready = sources.keys()
+            else:
+                ready = select.select(watched, [], [])[0]
+                if self._wakeup[0] in ready:
+                    finishing = True
+                    continue
+            for fd in ready:
+                with self._readLock:
+                    try:
+                        data = os.read(fd, 65536)
+                    except OSError, err:
+                        if err.errno != errno.EAGAIN:
+                            raise
+                        data = None
+                    if not data:
+                        # EOF, or nothing left to drain
+                        del sources[fd]
+                        watched.remove(fd)
+                        continue
+                    echoFd, destination = sources[fd]
+                    writeAll(echoFd, data)
+                    self.record(data, destination)
+
+    def startSuppressing(self):
+        # The header may still be in the pipes; let the reader log it first
+        self._whenDrained(super(FdOutputLogger, self).startSuppressing)
+
+    def stopSuppressing(self):
+        # Output written so far is still subject to suppression
+        self._whenDrained(super(FdOutputLogger, self).stopSuppressing)
+
+    def _whenDrained(self, func):
+        '''Call func once the reader has recorded everything written so far.'''
+        if self._pipes is None:
+            return func()    # not capturing
+        sys.stdout.flush()
+        sys.stderr.flush()
+        flushCStdio()
+        while True:
+            with self._readLock:
+                if not any(pipeBytesAvailable(rr) for rr, ww in self._pipes):
+                    return func()
+            time.sleep(.001)
+
+    def flush(self):
+        # Called from the reader thread, so leave the streams alone
+        self.logBuffer()
+
+
+
+def pipeBytesAvailable(fd):
+    '''Number of bytes that can be read from pipe fd without blocking.'''
+    buf = array.array('i', [0])
+    fcntl.ioctl(fd, termios.FIONREAD, buf, True)
+    return buf[0]
+
+
+
+def byteView(data):
+    '''Return a view of the bytes of data that os.write() accepts,
+    without copying them. Unicode is encoded as UTF-8.'''
+    if isinstance(data, unicode):
+        return memoryview(data.encode('utf-8'))
+    try:
+        view = memoryview(data)
+        if view.itemsize == 1 and view.ndim <= 1:
+            return view
+    except TypeError:
+        pass
+    # Only has the old buffer interface (array.array), or items wider
+    # than a byte, where memoryview lengths and slices count items
+    return buffer(data)
+
 
 
+def writeAll(fd, data):
+    '''os.write() all of data to fd, retrying on short writes.'''
+    view = byteView(data)
+    offset = 0
+    while offset < len(view):
+        if isinstance(view, memoryview):
+            offset += os.write(fd, view[offset:])
+        else:
+            offset += os.write(fd, buffer(view, offset))
+
+
+
+def flushCStdio():
+    '''Flush C stdio buffers, so output printed by C extensions is not
+    lost when file descriptors are switched. Best effort only.'''
+    try:
+        import ctypes
+        ctypes.CDLL(None).fflush(None)
+    except (ImportError, OSError, AttributeError):
+        pass
+
+
+
+METRICS_FD_ENV = 'GIT_RESULTS_MANAGER_METRICS_FD'
+METRICS_SUBDIR = 'metrics'
+
+def checkMetricName(name):
+    '''Raise ValueError unless name can be used as a metric name. Names
+    become file names in the metrics directory and are sent as the
+    first word of a text record, so they may not be empty, start with
+    '.', or contain '/' or whitespace.'''
+    if name.split() != [name] or '/' in name or name.startswith('.'):
+        raise ValueError('Bad metric name "%s"' % name)
+
+
+
+class MetricsWriter(object):
+    '''Collects scalar metric records and appends them in batches to
+    columnar files in <rundir>/metrics. Each metric NAME is stored as
+    two raw native-endian float64 files, NAME.time and NAME.value, so
+    they can be loaded as arrays without any text parsing (see
+    loadMetrics).
+
+    Records may be added directly with add() or as text with
+    addRecords(), which accepts lines of the form "name value" or
+    "name value timestamp", as written by logMetric().
+
+    Pending records are written once batchSize of them have piled up,
+    or when records are added or flushIfDue() is called at least
+    flushInterval seconds after the last write, so that slowly logged
+    metrics show up in loadMetrics() without much delay.'''
+
+    def __init__(self, rundir, batchSize = 4096, flushInterval = 10):
+        self.dirname = os.path.join(rundir, METRICS_SUBDIR)
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.columns = {}      # name -> (times, values)
+        self.nPending = 0
+        self.nBadRecords = 0
+        self.partial = ''
+        self.lastFlush = time.time()
+
+    def add(self, name, value, timestamp = None):
+        checkMetricName(name)
+        if timestamp is None:
+            timestamp = time.time()
+        if name not in self.columns:
+            self.columns[name] = (array.array('d'), array.array('d'))
+        times, values = self.columns[name]
+        times.append(timestamp)
+        values.append(value)
+        self.nPending += 1
+        if self.nPending >= self.batchSize:
+            self.flush()
+        else:
+            self.flushIfDue()
+
+    def flushIfDue(self):
+        '''Flush if the last write was at least flushInterval seconds ago.'''
+        if self.nPending and time.time() - self.lastFlush >= self.flushInterval:
+            self.flush()
 
-def runCmd(args, supressErr = False):
-    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    def addRecords(self, data):
+        '''Parse newline terminated records from data. Incomplete
+        trailing records are kept until the rest arrives.'''
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self._addLine(line)
+
+    def _addLine(self, line):
+        parts = line.split()
+        if not parts:
+            return
+        try:
+            if len(parts) == 2:
+                self.add(parts[0], float(parts[1]))
+            elif len(parts) == 3:
+                self.add(parts[0], float(parts[1]), float(parts[2]))
+            else:
+                raise ValueError
+        except ValueError:
+            self.nBadRecords += 1
+
+    def flush(self):
+        self.lastFlush = time.time()
+        if self.nPending == 0:
+            return
+        if not os.path.isdir(self.dirname):
+            os.mkdir(self.dirname)
+        for name, (times, values) in self.columns.iteritems():
+            if not times:
+                continue
+            with open(os.path.join(self.dirname, name + '.time'), 'ab') as ff:
+                times.tofile(ff)
+            with open(os.path.join(self.dirname, name + '.value'), 'ab') as ff:
+                values.tofile(ff)
+            del times[:]
+            del values[:]
+        self.nPending = 0
+
+    def close(self):
+        if self.partial:
+            self._addLine(self.partial)
+            self.partial = ''
+        self.flush()
+
+
+
+def loadMetrics(rundir):
+    '''Load metrics written by MetricsWriter. Returns a dict mapping
+    metric name to a (times, values) tuple of arrays. numpy arrays are
+    returned if numpy is available, otherwise array.array('d'). rundir
+    may also be given by its flat path in a date or hash layout.'''
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    dirname = os.path.join(resolveRunDir(rundir), METRICS_SUBDIR)
+    ret = {}
+    if not os.path.isdir(dirname):
+        return ret
+    for filename in sorted(os.listdir(dirname)):
+        if not filename.endswith('.value'):
+            continue
+        name = filename[:-len('.value')]
+        columns = []
+        for suffix in ('.time', '.value'):
+            path = os.path.join(dirname, name + suffix)
+            if numpy is not None:
+                columns.append(numpy.fromfile(path, dtype = numpy.float64))
+            else:
+                col = array.array('d')
+                with open(path, 'rb') as ff:
+                    col.fromstring(ff.read())
+                columns.append(col)
+        # Guard against a torn final batch
+        nn = min(len(columns[0]), len(columns[1]))
+        ret[name] = (columns[0][:nn], columns[1][:nn])
+    return ret
+
+
+
+_metricsFd = None
+
+def logMetric(name, value):
+    '''Record a scalar metric for the current run. When running under
+    resman, the record is sent over the pipe advertised in
+    GIT_RESULTS_MANAGER_METRICS_FD; otherwise it is stored by the
+    global resman instance, if it has been started.'''
+    global _metricsFd
+    checkMetricName(name)
+    if _metricsFd is None:
+        _metricsFd = int(os.environ.get(METRICS_FD_ENV, -1))
+        # A process started with close_fds inherits the variable but
+        # not the pipe, and the fd number may have been reused since
+        try:
+            if _metricsFd >= 0 and not stat.S_ISFIFO(os.fstat(_metricsFd).st_mode):
+                _metricsFd = -1
+        except OSError:
+            _metricsFd = -1
+    if _metricsFd >= 0:
+        os.write(_metricsFd, '%s %r %r\n' % (name, float(value), time.time()))
+    elif resman.rundir:
+        resman.logMetric(name, value)
+    else:
+        raise Exception('logMetric called, but not running under resman and resman.start() was not called.')
+
+
+
+PROFILE_ENV = 'GIT_RESULTS_MANAGER_PROFILE'
+PROFILE_MODES = ('thread', 'signal')
+
+class StackSampler(object):
+    '''Statistical profiler that records the Python call stack every
+    interval seconds.
+
+    In 'thread' mode a background thread samples the stacks of all
+    other threads (wall clock time, so time spent waiting shows up too).
+    In 'signal' mode a SIGPROF interval timer samples the main thread
+    when it is using CPU; this only works if started from the main
+    thread and takes over SIGPROF.
+
+    Stacks are counted in a dict keyed by tuples of cached frame labels,
+    so a sample costs a walk up the stack and a dict update. At the
+    default rate of 100 samples per second this is well under 1% of a
+    CPU for typical stack depths.'''
+
+    def __init__(self, interval = 0.01, mode = 'thread'):
+        if mode not in PROFILE_MODES:
+            raise Exception('Unknown profiler mode "%s", expected one of %s' % (mode, ', '.join(PROFILE_MODES)))
+        self.interval = interval
+        self.mode = mode
+        self.counts = collections.defaultdict(int)   # stack tuple (outermost first) -> samples
+        self.nSamples = 0
+        self._labels = {}    # code object -> frame label
+        self._thread = None
+        self._stopEvent = threading.Event()
+        self._prevHandler = None
+
+    def start(self):
+        if self.mode == 'signal':
+            self._prevHandler = signal.signal(signal.SIGPROF, self._handleSignal)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        else:
+            self._thread = threading.Thread(name = 'stack-sampler-thread', target = self._sampleThreads)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def stop(self):
+        if self.mode == 'signal':
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self._prevHandler or signal.SIG_DFL)
+        elif self._thread:
+            self._stopEvent.set()
+            self._thread.join()
+            self._thread = None
+
+    def finish(self, rundir):
+        '''Stop sampling and save the results in rundir.'''
+        self.stop()
+        self.save(rundir)
+
+    def save(self, rundir, nTop = 40):
+        '''Write the samples to rundir: profile.collapsed has one
+        "frame;frame;... count" line per distinct stack, the input
+        format of flamegraph.pl and speedscope, and profile.txt lists
+        the functions with the most samples.'''
+        with open(os.path.join(rundir, 'profile.collapsed'), 'w') as ff:
+            for stack, count in sorted(self.counts.iteritems()):
+                ff.write('%s %d\n' % (';'.join(stack), count))
+        selfCounts = collections.defaultdict(int)
+        totalCounts = collections.defaultdict(int)
+        for stack, count in self.counts.iteritems():
+            if self.mode == 'thread':
+                stack = stack[1:]    # thread name
+            if not stack:
+                continue
+            selfCounts[stack[-1]] += count
+            for label in set(stack):
+                totalCounts[label] += count
+        nn = float(max(1, self.nSamples))
+        with open(os.path.join(rundir, 'profile.txt'), 'w') as ff:
+            print >>ff, 'Samples: %d (one every %g s, %s mode)' % (self.nSamples, self.interval, self.mode)
+            print >>ff
+            print >>ff, '  self%  total%  function'
+            for label in sorted(totalCounts, key = lambda ll: (-selfCounts[ll], -totalCounts[ll], ll))[:nTop]:
+                print >>ff, '%6.1f  %6.1f  %s' % (100 * selfCounts[label] / nn, 100 * totalCounts[label] / nn, label)
+
+    def _stackOf(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+            stack.append(label)
+            frame = frame.f_back
+        stack.reverse()
+        return stack
+
+    def _handleSignal(self, signum, frame):
+        self.counts[tuple(self._stackOf(frame))] += 1
+        self.nSamples += 1
+
+    def _sampleThreads(self):
+        myId = threading.current_thread().ident
+        while not self._stopEvent.wait(self.interval):
+            names = dict((tt.ident, tt.name) for tt in threading.enumerate())
+            for threadId, frame in sys._current_frames().items():
+                if threadId != myId:
+                    self.counts[tuple([names.get(threadId, 'thread-%d' % threadId)] + self._stackOf(frame))] += 1
+            self.nSamples += 1
+
+
+
+def startProfilerFromEnv(setting = None):
+    '''Start a StackSampler if asked to by resman --profile through
+    GIT_RESULTS_MANAGER_PROFILE ("mode:interval"), or by setting if
+    the caller already took it from there. The results are saved in
+    GIT_RESULTS_MANAGER_DIR when the process exits. The variable is
+    removed, so subprocesses are not profiled.'''
+    if setting is None:
+        setting = os.environ.pop(PROFILE_ENV, None)
+    rundir = os.environ.get('GIT_RESULTS_MANAGER_DIR')
+    if not setting or not rundir:
+        return None
+    mode, interval = setting.split(':')
+    sampler = StackSampler(float(interval), mode)
+    sampler.start()
+    atexit.register(sampler.finish, rundir)
+    return sampler
+
+
+
+def runCmd(args, supressErr = False, cwd = None):
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
     out,err = proc.communicate()
     code = proc.wait()
 
@@ -185,19 +910,19 @@ def runCmd(args, supressErr = False):
 
 
 
-def gitWorks():
-    code,out,err = runCmd(('git','status'), supressErr = True)
+def gitWorks(cwd = None):
+    code,out,err = runCmd(('git','status'), supressErr = True, cwd = cwd)
     return code == 0
 
 
 
-def gitLastCommit():
-    return runCmd(('git', 'rev-parse', '--short', 'HEAD'))[1].strip()
+def gitLastCommit(cwd = None):
+    return runCmd(('git', 'rev-parse', '--short', 'HEAD'), cwd = cwd)[1].strip()
 
 
 
-def gitCurrentBranch():
-    code, out, err = runCmd(('git', 'branch'))
+def gitCurrentBranch(cwd = None):
+    code, out, err = runCmd(('git', 'branch'), cwd = cwd)
     for line in out.split('\n'):
         if len(line) > 2 and line[0] == '*':
             ret = line[2:]
@@ -208,16 +933,16 @@ def gitCurrentBranch():
 
 
 
-def gitStatus():
-    return runCmd(('git', 'status'))[1].strip()
+def gitStatus(cwd = None):
+    return runCmd(('git', 'status'), cwd = cwd)[1].strip()
 
 
 
-def gitDiff(color = False):
+def gitDiff(color = False, cwd = None):
     if color:
-        return runCmd(('git', 'diff', '--color'))[1].strip()
+        return runCmd(('git', 'diff', '--color'), cwd = cwd)[1].strip()
     else:
-        return runCmd(('git', 'diff'))[1].strip()
+        return runCmd(('git', 'diff'), cwd = cwd)[1].strip()
 
 
 
@@ -231,17 +956,572 @@ def env():
 
 
 
+def probeRunInfo(cwd = None):
+    '''Collect the git and host information saved with each run.'''
+    info = {'useGit': gitWorks(cwd), 'hostname': hostname()}
+    if info['useGit']:
+        info['lastCommit'] = gitLastCommit(cwd)
+        info['curBranch'] = gitCurrentBranch(cwd)
+        info['gitStatus'] = gitStatus(cwd)
+        info['gitDiff'] = gitDiff(cwd = cwd)
+        info['gitColorDiff'] = gitDiff(color = True, cwd = cwd)
+    return info
+
+
+
+# Results directory layouts. Run directories are either placed directly
+# in the results directory ('flat'), or in a shard subdirectory named
+# after the run's date ('date', e.g. results/121030/121030_183101_...) or
+# the first two hex digits of the md5 of its name ('hash'). The shard
+# follows from the run name, so runs stay resolvable by their flat name.
+LAYOUTS = ('flat', 'date', 'hash')
+LAYOUT_FILE = '.layout'
+_shardRe = re.compile(r'^([0-9]{6}|[0-9a-f]{2})$')
+
+def runShard(name, layout):
+    '''Shard subdirectory for run name in the given layout ('' if flat).'''
+    if layout == 'date':
+        return name[:6]
+    elif layout == 'hash':
+        return hashlib.md5(name).hexdigest()[:2]
+    elif layout == 'flat':
+        return ''
+    raise Exception('Unknown results directory layout "%s", expected one of %s' % (layout, ', '.join(LAYOUTS)))
+
+
+
+def isShardDir(name):
+    # Run names are longer, so they never match
+    return bool(_shardRe.match(name))
+
+
+
+def readLayout(resultsSubdir):
+    '''Default layout for new runs in resultsSubdir, as set by "resman migrate".'''
+    try:
+        with open(os.path.join(resultsSubdir, LAYOUT_FILE), 'r') as ff:
+            return ff.read().strip()
+    except IOError:
+        return 'flat'
+
+
+
+def resolveRunDir(path):
+    '''Find the run directory given by its flat path (results/<name>)
+    in whatever layout it is stored. Returns path unchanged if the run
+    cannot be found.'''
+    if os.path.isdir(path):
+        return path
+    resultsSubdir, name = os.path.split(os.path.normpath(path))
+    for layout in LAYOUTS:
+        candidate = os.path.join(resultsSubdir, runShard(name, layout), name)
+        if os.path.isdir(candidate):
+            return candidate
+    return path
+
+
+
+def makeRunDir(resultsSubdir, description, info, layout = 'flat'):
+    '''Create a uniquely named run directory in resultsSubdir (in the
+    shard given by layout) and return its name.'''
+    timestamp = datetime.datetime.now().strftime('%y%m%d_%H%M%S')
+    if info['useGit']:
+        basename = '%s_%s_%s' % (timestamp, info['lastCommit'], info['curBranch'])
+    else:
+        basename = '%s' % timestamp
+
+    if description:
+        basename += '_%s' % description
+    success = False
+    ii = 0
+    while not success:
+        name = basename + ('_%d' % ii if ii > 0 else '')
+        shardDir = os.path.join(resultsSubdir, runShard(name, layout))
+        if not os.path.isdir(shardDir):
+            try:
+                os.mkdir(shardDir)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+        try:
+            os.mkdir(os.path.join(shardDir, name))
+            success = True
+        except OSError:
+            #print >>sys.stderr, name, 'already exists, appending suffix to name'
+            ii += 1
+    return name
+
+
+
+class GitSnapshotCache(object):
+    '''Caches probeRunInfo() results per working directory. A cached
+    snapshot is reused as long as a single "git status --porcelain=v2"
+    call shows the same HEAD, branch and index entries, and the changed
+    files have the same size and mtime as when it was taken.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hostname = hostname()
+        self._toplevel = {}     # cwd -> repository root
+        self._snapshots = {}    # cwd -> (key, info)
+
+    def probe(self, cwd):
+        key = self._key(cwd)
+        with self._lock:
+            cached = self._snapshots.get(cwd)
+        if key is not None and cached is not None and cached[0] == key:
+            return cached[1]
+        info = probeRunInfo(cwd)
+        info['hostname'] = self._hostname
+        if key is not None:
+            with self._lock:
+                self._snapshots[cwd] = (key, info)
+        return info
+
+    def _key(self, cwd):
+        code, out, err = runCmd(('git', 'status', '--porcelain=v2', '--branch'), supressErr = True, cwd = cwd)
+        if code != 0:
+            return None    # not a repository, or git too old for porcelain v2
+        if cwd not in self._toplevel:
+            self._toplevel[cwd] = runCmd(('git', 'rev-parse', '--show-toplevel'), cwd = cwd)[1].strip()
+        stats = []
+        for line in out.split('\n'):
+            if line.startswith('1 '):
+                path = line.split(' ', 8)[8]
+            elif line.startswith('2 '):
+                path = line.split(' ', 9)[9].split('\t')[0]
+            elif line.startswith('u '):
+                path = line.split(' ', 10)[10]
+            else:
+                continue
+            try:
+                st = os.stat(os.path.join(self._toplevel[cwd], path))
+                stats.append((st.st_size, st.st_mtime))
+            except OSError:
+                stats.append(None)
+        return out, tuple(stats)
+
+
+
+UNTRACKED_STORE = '.untracked'
+
+def snapshotUntrackedFiles(manifestPath, storeDir, storeRelPath, maxSize, excludeDirs = (), cwd = None):
+    '''Save the untracked, non-ignored files of the repository at cwd.
+
+    File contents go to a content-addressed store shared by all runs
+    (storeDir/<sha1[:2]>/<sha1[2:]>), and manifestPath lists "sha1 mode
+    path" for each file, with paths relative to the repository root.
+    storeRelPath, the store location relative to the run directory, is
+    recorded in the manifest for git-recreate. A cache in the store
+    maps (path, size, mtime) to sha1, so only new or changed files are
+    read. Files larger than maxSize bytes are listed but not saved, and
+    files under excludeDirs (e.g. the results directory) are ignored.'''
+    toplevel = runCmd(('git', 'rev-parse', '--show-toplevel'), cwd = cwd)[1].strip()
+    out = runCmd(('git', 'ls-files', '--others', '--exclude-standard', '-z'), cwd = toplevel)[1]
+    cachePath = os.path.join(storeDir, 'cache')
+    cache = {}      # abspath -> (size, mtime, sha1)
+    try:
+        with open(cachePath, 'r') as ff:
+            for line in ff:
+                sha, size, mtime, path = line.rstrip('\n').split(' ', 3)
+                cache[path] = (int(size), float(mtime), sha)
+    except IOError:
+        pass
+    cacheChanged = False
+    excludes = tuple(os.path.realpath(dd) + os.sep for dd in excludeDirs)
+
+    lines = ['# store: %s' % storeRelPath]
+    for relPath in sorted(out.split('\0')):
+        if not relPath:
+            continue
+        path = os.path.join(toplevel, relPath)
+        if excludes and os.path.realpath(path).startswith(excludes):
+            continue
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            lines.append('# skipped (not a regular file): %s' % relPath)
+            continue
+        if st.st_size > maxSize:
+            lines.append('# skipped (%d bytes > %d): %s' % (st.st_size, maxSize, relPath))
+            continue
+        cached = cache.get(path)
+        if cached and cached[:2] == (st.st_size, st.st_mtime):
+            sha = cached[2]
+        else:
+            with open(path, 'rb') as ff:
+                contents = ff.read()
+            sha = hashlib.sha1(contents).hexdigest()
+            objPath = os.path.join(storeDir, sha[:2], sha[2:])
+            if not os.path.exists(objPath):
+                if not os.path.isdir(os.path.dirname(objPath)):
+                    os.makedirs(os.path.dirname(objPath))
+                tmpPath = '%s.%d.tmp' % (objPath, os.getpid())
+                with open(tmpPath, 'wb') as ff:
+                    ff.write(contents)
+                os.rename(tmpPath, objPath)
+            cache[path] = (st.st_size, st.st_mtime, sha)
+            cacheChanged = True
+        lines.append('%s %o %s' % (sha, stat.S_IMODE(st.st_mode), relPath))
+
+    with open(manifestPath, 'w') as ff:
+        ff.write('\n'.join(lines) + '\n')
+    if cacheChanged:
+        tmpPath = '%s.%d.tmp' % (cachePath, os.getpid())
+        with open(tmpPath, 'w') as ff:
+            for path, (size, mtime, sha) in cache.iteritems():
+                ff.write('%s %d %r %s\n' % (sha, size, mtime, path))
+        os.rename(tmpPath, cachePath)
+
+
+
+DAEMON_SOCKET_ENV = 'GIT_RESULTS_MANAGER_SOCKET'
+
+def daemonSocketPath():
+    '''Per-user socket on which the resman daemon listens.'''
+    if os.environ.get(DAEMON_SOCKET_ENV):
+        return os.environ[DAEMON_SOCKET_ENV]
+    runtimeDir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(runtimeDir, 'resman-%d.sock' % os.getuid())
+
+
+
+def _dumpMessage(dd):
+    # git output and paths need not be valid UTF-8, which json requires,
+    # so strings travel escaped to ASCII
+    return json.dumps(dict((kk, vv.encode('string_escape') if isinstance(vv, str) else vv) for kk, vv in dd.iteritems()))
+
+def _loadMessage(line):
+    # json gives back unicode; the rest of the module deals in str
+    return dict((str(kk), vv.encode('ascii').decode('string_escape') if isinstance(vv, unicode) else vv)
+                for kk, vv in json.loads(line).iteritems())
+
+
+
+class _DaemonHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return    # connection was just checking that we are alive
+        runDir = None
+        try:
+            request = _loadMessage(line)
+            info = self.server.cache.probe(request['cwd'])
+            _dumpMessage(info)    # fail before creating the run directory, not after
+            resultsSubdir = os.path.join(request['cwd'], request['resultsSubdir'])
+            layout = request.get('layout', 'flat')
+            name = makeRunDir(resultsSubdir, request['description'], info, layout)
+            runDir = os.path.join(resultsSubdir, runShard(name, layout), name)
+            reply = _dumpMessage(dict(info, name = name))
+        except Exception, ee:
+            if runDir is not None:
+                os.rmdir(runDir)
+                runDir = None
+            reply = _dumpMessage({'error': '%s: %s' % (ee.__class__.__name__, ee)})
+        try:
+            self.wfile.write(reply + '\n')
+            self.wfile.flush()
+        except socket.error:
+            # The client will not use the run directory, so do not leave it behind
+            if runDir is not None:
+                os.rmdir(runDir)
+            raise
+
+
+
+class ResmanDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''Per-user server that keeps probe results warm (see
+    GitSnapshotCache) and allocates run directories on behalf of
+    GitResultsManager.start(), which uses it when it is running.'''
+
+    daemon_threads = True
+
+    def __init__(self, socketPath = None):
+        self.socketPath = socketPath or daemonSocketPath()
+        if os.path.exists(self.socketPath):
+            if requestRunFromDaemon('.', '', self.socketPath, probeOnly = True) is not None:
+                raise Exception('A resman daemon is already listening on %s' % self.socketPath)
+            os.unlink(self.socketPath)   # stale socket from a previous daemon
+        self.cache = GitSnapshotCache()
+        oldUmask = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, self.socketPath, _DaemonHandler)
+        finally:
+            os.umask(oldUmask)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socketPath):
+            os.unlink(self.socketPath)
+
+
+
+def requestRunFromDaemon(resultsSubdir, description, socketPath = None, probeOnly = False, layout = 'flat'):
+    '''Ask a running resman daemon to probe git and create a run
+    directory. Returns (name, info), or None if no daemon is reachable,
+    in which case the caller should do the work itself. With
+    probeOnly, just returns whether a daemon answered.'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socketPath or daemonSocketPath())
+        except socket.error:
+            return None
+        if probeOnly:
+            return True
+        request = {'cwd': os.getcwd(), 'resultsSubdir': resultsSubdir, 'description': description, 'layout': layout}
+        try:
+            sock.sendall(_dumpMessage(request) + '\n')
+            sock.shutdown(socket.SHUT_WR)
+            response = sock.makefile('r').read()
+        except socket.error:
+            return None
+    finally:
+        sock.close()
+    if not response:
+        return None
+    response = _loadMessage(response)
+    if 'error' in response:
+        print >>sys.stderr, 'WARNING: resman daemon failed (%s), probing git directly' % response['error']
+        return None
+    return response.pop('name'), response
+
+
+
+def pidAlive(pid, host = None):
+    '''Whether process pid is running. Processes on other hosts are
+    assumed to be alive, since we cannot check them.'''
+    if host is not None and host != socket.gethostname():
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        return err.errno == errno.EPERM
+    return True
+
+
+
+ACTIVE_MARKER = '.grm_active'
+STAGING_MARKER = '.grm_staging'
+
+class StagingSyncer(object):
+    '''Mirrors a run directory kept on fast local disk (the staging
+    directory) to its final location in the results directory. Files
+    that only grew since the last sync, like the diary, have just their
+    new bytes appended; other changed files are copied whole. A file is
+    considered grown if it is still the same inode and the last block
+    before the synced size still matches the destination, so files
+    rewritten with longer contents are copied whole too.
+
+    While the run is in progress, a marker file in the staging
+    directory records the owning pid and the destination, so that
+    recoverStaging() can flush runs left behind by a crash.'''
+
+    def __init__(self, stagingRundir, destRundir, interval = 30):
+        self.stagingRundir = stagingRundir
+        self.destRundir = destRundir
+        self.interval = interval
+        self.synced = {}        # relative path -> (size, mtime, inode) at last sync
+        self._lock = threading.Lock()
+        self._stopEvent = threading.Event()
+        self._thread = None
+
+    def writeMarker(self):
+        with open(os.path.join(self.stagingRundir, STAGING_MARKER), 'w') as ff:
+            ff.write('%d %s %s\n' % (os.getpid(), socket.gethostname(), os.path.abspath(self.destRundir)))
+
+    def startPeriodic(self):
+        if self.interval and self.interval > 0:
+            self._thread = threading.Thread(name = 'staging-sync-thread', target = self._periodic)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def _periodic(self):
+        while not self._stopEvent.wait(self.interval):
+            self.sync()
+
+    def sync(self):
+        with self._lock:
+            for dirpath, dirnames, filenames in os.walk(self.stagingRundir):
+                relDir = os.path.relpath(dirpath, self.stagingRundir)
+                destDir = os.path.normpath(os.path.join(self.destRundir, relDir))
+                if not os.path.isdir(destDir):
+                    os.makedirs(destDir)
+                for filename in filenames:
+                    if relDir == '.' and filename == STAGING_MARKER:
+                        continue
+                    self._syncFile(os.path.normpath(os.path.join(relDir, filename)))
+
+    def _syncFile(self, relPath):
+        src = os.path.join(self.stagingRundir, relPath)
+        dest = os.path.join(self.destRundir, relPath)
+        try:
+            st = os.stat(src)
+        except OSError:
+            return   # removed since os.walk listed it
+        prevSize, prevMtime, prevIno = self.synced.get(relPath, (None, None, None))
+        if (st.st_size, st.st_mtime, st.st_ino) == (prevSize, prevMtime, prevIno):
+            return
+        if prevSize is not None and st.st_size > prevSize and st.st_ino == prevIno and self._prefixUnchanged(src, dest, prevSize):
+            # Append only the new bytes
+            with open(src, 'rb') as fin:
+                fin.seek(prevSize)
+                with open(dest, 'ab') as fout:
+                    fout.seek(prevSize)
+                    fout.truncate()
+                    shutil.copyfileobj(fin, fout, 1 << 20)
+        else:
+            shutil.copyfile(src, dest)
+        self.synced[relPath] = (st.st_size, st.st_mtime, st.st_ino)
+
+    @staticmethod
+    def _prefixUnchanged(src, dest, size, blockSize = 4096):
+        '''Whether the last block before size is the same in src and
+        dest, i.e. src was most likely appended to rather than rewritten.'''
+        start = max(0, size - blockSize)
+        try:
+            blocks = []
+            for path in (src, dest):
+                with open(path, 'rb') as ff:
+                    ff.seek(start)
+                    blocks.append(ff.read(size - start))
+        except IOError:
+            return False
+        return blocks[0] == blocks[1] and len(blocks[0]) == size - start
+
+    def finish(self):
+        '''Stop periodic syncing, do a final sync and remove the staging directory.'''
+        self._stopEvent.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.sync()
+        shutil.rmtree(self.stagingRundir)
+
+
+
+def recoverStaging(stagingDir):
+    '''Flush staged runs whose owning process is gone (e.g. it
+    crashed) to their results directories. Returns the list of
+    recovered destination directories.'''
+    recovered = []
+    if not os.path.isdir(stagingDir):
+        return recovered
+    for name in os.listdir(stagingDir):
+        stagingRundir = os.path.join(stagingDir, name)
+        try:
+            with open(os.path.join(stagingRundir, STAGING_MARKER), 'r') as ff:
+                pid, host, destRundir = ff.read().strip().split(' ', 2)
+        except (IOError, ValueError):
+            continue
+        if pidAlive(int(pid), host):
+            continue
+        print >>sys.stderr, 'Recovering unsynced staging directory %s to %s' % (stagingRundir, destRundir)
+        StagingSyncer(stagingRundir, destRundir).finish()
+        recovered.append(destRundir)
+    return recovered
+
+
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def iterRunDirs(resultsSubdir):
+    '''Yield (name, path) for each run directory in resultsSubdir.
+    Uses scandir, if available, to avoid a stat() per entry. Hidden
+    directories (such as the untracked file store) are skipped, and
+    shard directories of sharded layouts are descended into.'''
+    for name, path in _iterSubdirs(resultsSubdir):
+        if isShardDir(name):
+            for item in _iterSubdirs(path):
+                yield item
+        else:
+            yield name, path
+
+def _iterSubdirs(dirname):
+    if scandir is not None:
+        for entry in scandir(dirname):
+            if not entry.name.startswith('.') and entry.is_dir():
+                yield entry.name, entry.path
+    else:
+        for name in os.listdir(dirname):
+            path = os.path.join(dirname, name)
+            if not name.startswith('.') and os.path.isdir(path):
+                yield name, path
+
+
+
+def runIsActive(rundir):
+    '''Whether the run in rundir is still in progress, according to
+    the marker GitResultsManager.start() leaves until stop().'''
+    try:
+        with open(os.path.join(rundir, ACTIVE_MARKER), 'r') as ff:
+            pid, host = ff.read().split()
+    except (IOError, ValueError):
+        return False
+    return pidAlive(int(pid), host)
+
+
+
+def runFooter(rundir, tailBytes = 4096):
+    '''Read the end of the diary in rundir. Returns (finished,
+    exitCode): whether stop() wrote its wall time footer, and the exit
+    code recorded by resman, or None if there is none.'''
+    try:
+        with open(os.path.join(rundir, 'diary'), 'rb') as ff:
+            ff.seek(0, os.SEEK_END)
+            ff.seek(max(0, ff.tell() - tailBytes))
+            tail = ff.read()
+    except IOError:
+        return False, None
+    finished = 'Wall time: ' in tail
+    exitCode = None
+    idx = tail.rfind('Exit code: ')
+    if idx >= 0:
+        try:
+            exitCode = int(tail[idx:].split(None, 3)[2])
+        except (IndexError, ValueError):
+            pass
+    return finished, exitCode
+
+
+
 RESULTS_SUBDIR = 'results'
 
 class GitResultsManager(object):
     '''Creates directory for results. If created with
     resumeExistingRun, load info from that run, usually just so the
-    run can be finished and the diary properly terminated.'''
+    run can be finished and the diary properly terminated.
+
+    If stagingDir is given (e.g. a directory on local disk or tmpfs
+    when the results directory is on NFS), the run directory is
+    written there and copied to the results directory every
+    syncInterval seconds and at stop(). rundir then refers to the
+    staging copy, and resultsRundir to the final location.
 
-    def __init__(self, resultsSubdir = None, resumeExistingRun = None):
+    If a resman daemon (ResmanDaemon) is running, start() gets git
+    information and the run directory from it rather than probing from
+    scratch, unless useDaemon is False.
+
+    layout chooses where run directories go within the results
+    directory: 'flat', or sharded by 'date' or 'hash' (see LAYOUTS).
+    It defaults to the layout recorded by "resman migrate", else flat.'''
+
+    def __init__(self, resultsSubdir = None, resumeExistingRun = None, stagingDir = None, syncInterval = 30, useDaemon = True,
+                 layout = None):
         self._resumeExistingRun = resumeExistingRun
+        self._syncer = None
         if self._resumeExistingRun:
             # if user provided a directory to load in.
+            self._resumeExistingRun = resolveRunDir(self._resumeExistingRun)
+            dirExists = False
             try:
                 dirExists = stat.S_ISDIR(os.stat(self._resumeExistingRun).st_mode)
             except OSError:
@@ -258,6 +1538,8 @@ class GitResultsManager(object):
             self.startWall = time.mktime(startWallDt.timetuple())
             self.startProc = None
             self.diary = False   # External run, so it's not a diary we're managing
+            self._metrics = None
+            self._profiler = None
 
             print 'grabbed time:', self.startWall
 
@@ -267,9 +1549,41 @@ class GitResultsManager(object):
                 self._resultsSubdir = RESULTS_SUBDIR
             self._name = None
             self._outLogger = None
+            self._metrics = None
+            self._profiler = None
+            self._stagingDir = stagingDir
+            self._syncInterval = syncInterval
+            self._useDaemon = useDaemon
+            self._layout = layout
             self.diary = None
 
-    def start(self, description = '', diary = True, createResultsDirIfMissing = False):
+    def start(self, description = '', diary = True, createResultsDirIfMissing = False, captureFds = False, workerSafe = False,
+              snapshotUntracked = False, untrackedMaxSize = 1 << 20, progressInterval = None,
+              profile = None, profileInterval = 0.01, foldRepeats = False, normalizeNumbers = False, maxLineRate = None):
+        '''Create a new run directory and start logging. If captureFds
+        is True, the diary captures file descriptors 1 and 2 (see
+        FdOutputLogger) rather than just sys.stdout and sys.stderr.
+        Pass workerSafe = True if the program forks workers (e.g. with
+        multiprocessing) that print; see OutputLogger.
+
+        With snapshotUntracked, untracked files that are not ignored and
+        at most untrackedMaxSize bytes are saved as well (see
+        snapshotUntrackedFiles), so that git-recreate can restore them.
+
+        Progress bars drawn with carriage returns are recorded in the
+        diary in their final state only, plus one sample every
+        progressInterval seconds if that is given.
+
+        With profile ('thread' or 'signal', or True for 'thread'), a
+        StackSampler records the call stack every profileInterval
+        seconds until stop(), which saves profile.collapsed and
+        profile.txt in the run directory.
+
+        foldRepeats folds runs of identical lines in the diary into
+        "last line repeated N times" records, normalizeNumbers does so
+        for lines differing only in numbers, and maxLineRate limits each
+        stream to that many diary lines per second; see LineSuppressor.
+        The terminal still gets all output.'''
         self.diary = diary
         dirExists = False
         try:
@@ -289,33 +1603,38 @@ class GitResultsManager(object):
             self.stop()
         self.diary = diary
 
-        # Test git
-        useGit = gitWorks()
-
-        timestamp = datetime.datetime.now().strftime('%y%m%d_%H%M%S')
-        if useGit:
-            lastCommit = gitLastCommit()
-            curBranch = gitCurrentBranch()
-            basename = '%s_%s_%s' % (timestamp, lastCommit, curBranch)
+        # Use the resman daemon's warm state if one is running
+        layout = self._layout or readLayout(self._resultsSubdir)
+        runShard('', layout)    # check it is a known layout
+        daemonRun = requestRunFromDaemon(self._resultsSubdir, description, layout = layout) if self._useDaemon else None
+        if daemonRun:
+            name, info = daemonRun
         else:
-            basename = '%s' % timestamp
-
-        if description:
-            basename += '_%s' % description
-        success = False
-        ii = 0
-        while not success:
-            name = basename + ('_%d' % ii if ii > 0 else '')
-            try:
-                os.mkdir(os.path.join(self._resultsSubdir, name))
-                success = True
-            except OSError:
-                #print >>sys.stderr, name, 'already exists, appending suffix to name'
-                ii += 1
+            info = probeRunInfo()
+            name = makeRunDir(self._resultsSubdir, description, info, layout)
+        self._shard = runShard(name, layout)
+        useGit = info['useGit']
         self._name = name
 
+        if self._stagingDir:
+            recoverStaging(self._stagingDir)
+            if not os.path.isdir(self._stagingDir):
+                os.makedirs(self._stagingDir)
+            os.mkdir(os.path.join(self._stagingDir, name))
+            self._syncer = StagingSyncer(os.path.join(self._stagingDir, name),
+                                         os.path.join(self._resultsSubdir, self._shard, name),
+                                         self._syncInterval)
+            self._syncer.writeMarker()
+            self._syncer.startPeriodic()
+
+        # Mark the run as in progress so that "resman prune" leaves it alone
+        with open(os.path.join(self.resultsRundir, ACTIVE_MARKER), 'w') as ff:
+            ff.write('%d %s\n' % (os.getpid(), socket.gethostname()))
+
         if self.diary:
-            self._outLogger = OutputLogger(os.path.join(self.rundir, 'diary'))
+            loggerClass = FdOutputLogger if captureFds else OutputLogger
+            self._outLogger = loggerClass(os.path.join(self.rundir, 'diary'), workerSafe, progressInterval,
+                                           foldRepeats, normalizeNumbers, maxLineRate)
             self._outLogger.startCapture()
 
         self.startWall = time.time()
@@ -326,9 +1645,11 @@ class GitResultsManager(object):
         gitDisableWarning = 'WARNING: GitResultsManager running in GIT_DISABLED mode: no git information saved! (Is %s in a git repo?)' % os.getcwd()
         if not useGit:
             print >>sys.stderr, gitDisableWarning
-        print '  Logging directory:', self.rundir
+        print '  Logging directory:', self.resultsRundir
+        if self._syncer:
+            print '  Staging directory:', self.rundir
         print '        Command run:', ' '.join(sys.argv)
-        print '           Hostname:', hostname()
+        print '           Hostname:', info['hostname']
         print '  Working directory:', os.getcwd()
         if not self.diary:
             print '<diary not saved>'
@@ -336,25 +1657,40 @@ class GitResultsManager(object):
             with open(os.path.join(self.rundir, 'diary'), 'w') as ff:
                 if not useGit:
                     print >>ff, gitDisableWarning
-                print >>ff, '  Logging directory:', self.rundir
+                print >>ff, '  Logging directory:', self.resultsRundir
+                if self._syncer:
+                    print >>ff, '  Staging directory:', self.rundir
                 print >>ff, '        Command run:', ' '.join(sys.argv)
-                print >>ff, '           Hostname:', hostname()
+                print >>ff, '           Hostname:', info['hostname']
                 print >>ff, '  Working directory:', os.getcwd()
                 print >>ff, '<diary not saved>'
 
         if useGit:
             with open(os.path.join(self.rundir, 'gitinfo'), 'w') as ff:
-                ff.write('%s %s\n' % (lastCommit, curBranch))
+                ff.write('%s %s\n' % (info['lastCommit'], info['curBranch']))
             with open(os.path.join(self.rundir, 'gitstat'), 'w') as ff:
-                ff.write(gitStatus() + '\n')
+                ff.write(info['gitStatus'] + '\n')
             with open(os.path.join(self.rundir, 'gitdiff'), 'w') as ff:
-                ff.write(gitDiff() + '\n')
+                ff.write(info['gitDiff'] + '\n')
             with open(os.path.join(self.rundir, 'gitcolordiff'), 'w') as ff:
-                ff.write(gitDiff(color=True) + '\n')
+                ff.write(info['gitColorDiff'] + '\n')
+            if snapshotUntracked:
+                snapshotUntrackedFiles(os.path.join(self.rundir, 'gituntracked'),
+                                       os.path.join(self._resultsSubdir, UNTRACKED_STORE),
+                                       os.path.relpath(os.path.join(self._resultsSubdir, UNTRACKED_STORE), self.resultsRundir),
+                                       untrackedMaxSize,
+                                       excludeDirs = filter(None, [self._resultsSubdir, self._stagingDir]))
         with open(os.path.join(self.rundir, 'env'), 'w') as ff:
             ff.write(env() + '\n')
+        if self.diary:
+            # The header above is always logged in full
+            self._outLogger.startSuppressing()
+        if profile:
+            self._profiler = StackSampler(profileInterval, 'thread' if profile is True else profile)
+            self._profiler.start()
 
     def stop(self, procTime = True):
+        activeMarker = os.path.join(self.resultsRundir, ACTIVE_MARKER)
         if self._resumeExistingRun:
             procTimeSec = '<unknown, not managed by GitResultsManager>'
         else:
@@ -365,21 +1701,55 @@ class GitResultsManager(object):
                 print >>ff, '       Wall time: ', fmtSeconds(time.time() - self.startWall)
                 if procTime:
                     print >>ff, '  Processor time: ', procTimeSec
+        if self._metrics is not None:
+            self._metrics.close()
+            self._metrics = None
+        if self._profiler is not None:
+            self._profiler.finish(self.rundir)
+            self._profiler = None
         self._name = None
+        self.stopSuppressing()
         print '       Wall time: ', fmtSeconds(time.time() - self.startWall)
         if procTime:
             print '  Processor time: ', procTimeSec
         if self.diary:
             self._outLogger.finishCapture()
             self._outLogger = None
+        if self._syncer:
+            self._syncer.finish()
+            self._syncer = None
+        if os.path.exists(activeMarker):
+            os.remove(activeMarker)
+
+    def stopSuppressing(self):
+        '''Log the lines left out of the diary so far (see LineSuppressor)
+        and log everything from now on, e.g. a footer. stop() calls this.'''
+        if self.diary and self._outLogger:
+            self._outLogger.stopSuppressing()
+
+    def logMetric(self, name, value):
+        '''Record a scalar metric in the metrics directory of the current run.'''
+        if self._metrics is None:
+            self._metrics = MetricsWriter(self.rundir)
+        self._metrics.add(name, value)
 
 
     @property
     def rundir(self):
         if self._resumeExistingRun:
             return self._resumeExistingRun
+        elif self._syncer:
+            return self._syncer.stagingRundir
         elif self._name:
-            return os.path.join(self._resultsSubdir, self._name)
+            return os.path.join(self._resultsSubdir, self._shard, self._name)
+
+    @property
+    def resultsRundir(self):
+        '''Location of the run in the results directory. Same as rundir
+        unless a staging directory is in use.'''
+        if self._syncer:
+            return self._syncer.destRundir
+        return self.rundir
 
     @property
     def runname(self):
@@ -522,6 +1892,150 @@ def with_timeout(timeout, func, *args, **kwargs):
 
 
 
+class InputBufferFull(Exception):
+    """Exception raised by AsyncProcess.write() when max_pending bytes of
+       input are already waiting and the write was not allowed to block.
+    """
+    pass
+
+
+def _find_sendfile():
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+    if not sys.platform.startswith('linux'):
+        return None    # BSD sendfile() only writes to sockets
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        c_sendfile = libc.sendfile64
+        c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+        c_sendfile.restype = ctypes.c_ssize_t
+    except (ImportError, OSError, AttributeError):
+        return None
+    def sendfile(out_fd, in_fd, offset, count):
+        off = ctypes.c_int64(offset)
+        ret = c_sendfile(out_fd, in_fd, ctypes.byref(off), count)
+        if ret < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return ret
+    return sendfile
+
+_sendfile = _find_sendfile()
+
+
+def copy_file_to_fd(fileobj, out_fd, chunk=1 << 20):
+    """Copy the rest of the file object fileobj to the file descriptor
+       out_fd.  Regular files are sent with sendfile(), where available,
+       so the data never passes through user space.
+    """
+    in_fd = fileobj.fileno()
+    if _sendfile is not None and stat.S_ISREG(os.fstat(in_fd).st_mode):
+        offset = fileobj.tell()
+        try:
+            while True:
+                sent = _sendfile(out_fd, in_fd, offset, chunk)
+                if sent == 0:
+                    break
+                offset += sent
+            fileobj.seek(offset)
+            return
+        except OSError, err:
+            if err.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+            fileobj.seek(offset)    # Not supported here, copy below
+    buf = bytearray(chunk)
+    view = memoryview(buf)
+    while True:
+        if hasattr(fileobj, 'readinto'):
+            nread = fileobj.readinto(buf)
+        else:
+            data = fileobj.read(chunk)
+            nread = len(data)
+            buf[:nread] = data
+        if not nread:
+            break
+        writeAll(out_fd, view[:nread])
+
+
+def monotonic_time():
+    """Seconds from a clock that is not affected by changes to the
+       system time.  Falls back to time.time() where no monotonic clock
+       can be found.
+    """
+    return _monotonic()
+
+def _find_monotonic():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        import ctypes, ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1    # Linux; also 6 on macOS, where clock_gettime may be missing
+        ts = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            raise OSError()
+        def monotonic():
+            clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        return monotonic
+    except (ImportError, OSError, AttributeError, TypeError):
+        return time.time
+
+_monotonic = _find_monotonic()
+
+
+def wait_all(procs, timeout):
+    """Wait until all the AsyncProcess objects in procs have terminated,
+       or until timeout (in seconds, may be fractional) has passed.
+       The processes are polled with waitpid(WNOHANG) with an increasing
+       interval, so no signals or threads are involved and this may be
+       called from any thread.  Returns the list of processes that are
+       still running.
+    """
+    deadline = monotonic_time() + timeout
+    interval = 0.001
+    running = list(procs)
+    while True:
+        running = [proc for proc in running if proc.wait(os.WNOHANG) is None]
+        remaining = deadline - monotonic_time()
+        if not running or remaining <= 0:
+            return running
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, 0.05)
+
+
+def terminate_all(procs, graceperiod=1):
+    """Terminate all the AsyncProcess objects in procs with escalating
+       force, like AsyncProcess.terminate(), but signalling all of them
+       at each level at once.  Shutting down any number of processes
+       therefore takes at most 2*GRACEPERIOD before they are SIGKILL:ed.
+    """
+    running = [proc for proc in procs if proc.wait(os.WNOHANG) is None]
+    with_stdin = [proc for proc in running if proc._process.stdin]
+    for proc in with_stdin:
+        proc.closeinput()
+    if with_stdin:
+        running = [proc for proc in running if proc not in with_stdin] + \
+                  wait_all(with_stdin, graceperiod)
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        for proc in running:
+            try:
+                proc.kill(sig)
+            except OSError:
+                pass    # Exited in the meantime
+        if sig == signal.SIGKILL:
+            break
+        running = wait_all(running, graceperiod)
+    for proc in running:
+        proc.wait()
+
+
+
 class AsyncProcess(object):
     """Manager for an asynchronous process.
        The process will be run in the background, and its standard output
@@ -536,10 +2050,14 @@ class AsyncProcess(object):
        block even if the process does not drain its input.
 
        On the other hand, this can consume large amounts of memory,
-       potentially even exhausting all memory available.
+       potentially even exhausting all memory available.  To avoid this,
+       pass max_pending, the number of bytes of input that may be waiting
+       to be fed to the process; write() then blocks (or raises
+       InputBufferFull) until the process has caught up.
 
        Parameters are identical to subprocess.Popen(), except that stdin,
-       stdout and stderr default to subprocess.PIPE instead of to None.
+       stdout and stderr default to subprocess.PIPE instead of to None,
+       and for the additional max_pending keyword parameter.
        Note that if you set stdout or stderr to anything but PIPE, the
        AsyncProcess object won't collect that output, and the read*() methods
        will always return empty strings.  Also, setting stdin to something
@@ -553,7 +2071,9 @@ class AsyncProcess(object):
             kwparams.setdefault('stdout', subprocess.PIPE)
         if len(params) <= 5:
             kwparams.setdefault('stderr', subprocess.PIPE)
-        self._pending_input = []
+        self._max_pending = kwparams.pop('max_pending', None)
+        self._pending_input = collections.deque()   # (data, size) tuples
+        self._pending_bytes = 0
         #self._collected_outdata = []
         #self._collected_errdata = []
         self._collected_outerr  = FinitePipe(10)    # collect both out and err together as tuples like (1, 'str...') or (2, 'str...')
@@ -561,7 +2081,7 @@ class AsyncProcess(object):
         self._collected_err_closed = False
         self._exitstatus = None
         self._lock = threading.Lock()
-        self._inputsem = threading.Semaphore(0)
+        self._input_cond = threading.Condition(self._lock)
         # Flag telling feeder threads to quit
         self._quit = False
 
@@ -661,27 +2181,35 @@ class AsyncProcess(object):
            terminate() waits up to GRACEPERIOD seconds (default 1) before
            escalating the level of force.  As there are three levels, a total
            of (3-1)*GRACEPERIOD is allowed before the process is SIGKILL:ed.
-           GRACEPERIOD must be an integer, and must be at least 1.
+           GRACEPERIOD may be fractional.  Waiting is done by polling (see
+           wait_timeout()), so terminate() does not touch SIGALRM and may be
+           called from any thread.
               If the process was started with stdin not set to PIPE, the
            first level (closing stdin) is skipped.
         """
         if self._process.stdin:
             # This is rather meaningless when stdin != PIPE.
             self.closeinput()
-            try:
-                return with_timeout(graceperiod, self.wait)
-            except Timeout:
-                pass
+            exitstatus = self.wait_timeout(graceperiod)
+            if exitstatus is not None:
+                return exitstatus
 
         self.kill(signal.SIGTERM)
-        try:
-            return with_timeout(graceperiod, self.wait)
-        except Timeout:
-            pass
+        exitstatus = self.wait_timeout(graceperiod)
+        if exitstatus is not None:
+            return exitstatus
 
         self.kill(signal.SIGKILL)
         return self.wait()
 
+    def wait_timeout(self, timeout):
+        """Like wait(), but give up after TIMEOUT seconds (may be
+           fractional), returning None if the process is still running.
+        """
+        if wait_all([self], timeout):
+            return None
+        return self.wait()
+
     def _outreader(self, collector, source):
         """Read data from out source until EOF, adding it to collector.
         """
@@ -711,18 +2239,39 @@ class AsyncProcess(object):
         return
 
     def _feeder(self, pending, drain):
-        """Feed data from the list pending to the file drain.
+        """Feed data from the deque pending to the file drain.
         """
+        fd = drain.fileno()
         while True:
-            self._inputsem.acquire()
-            self._lock.acquire()
-            if not pending  and         self._quit:
+            self._input_cond.acquire()
+            while not pending and not self._quit:
+                self._input_cond.wait()
+            if not pending:
                 drain.close()
-                self._lock.release()
+                self._input_cond.release()
                 break
-            data = pending.pop(0)
-            self._lock.release()
-            drain.write(data)
+            data, size = pending.popleft()
+            self._input_cond.release()
+            try:
+                if hasattr(data, 'fileno'):
+                    copy_file_to_fd(data, fd)
+                else:
+                    writeAll(fd, data)
+            except (IOError, OSError), err:
+                if err.errno != errno.EPIPE:
+                    raise
+                # The process closed its input; drop the rest
+                self._input_cond.acquire()
+                pending.clear()
+                self._pending_bytes = 0
+                self._quit = True
+                self._input_cond.notify_all()
+                self._input_cond.release()
+                continue
+            self._input_cond.acquire()
+            self._pending_bytes -= size
+            self._input_cond.notify_all()
+            self._input_cond.release()
 
     def read(self):
         """Blocking read of data written by the process to stdout or stderr.
@@ -762,22 +2311,52 @@ class AsyncProcess(object):
         self._lock.release()
         return output,error
 
-    def write(self, data):
+    def write(self, data, block=True):
         """Send data to a process's standard input.
+           DATA may be a string or any other object supporting the buffer
+           interface (bytearray, memoryview, array, ...), which is queued
+           without being copied, so it must not be modified until it has
+           been consumed.  A unicode string is encoded as UTF-8.  DATA may also be a file object, whose remaining
+           contents are streamed to the process (with sendfile() for
+           regular files on Linux) without being read into memory.
+              If max_pending was given and the pending input would exceed
+           it, write() blocks until there is room, or raises InputBufferFull
+           if BLOCK is false.  A single write larger than max_pending is
+           accepted once everything before it has been consumed.
+              Raises IOError(EPIPE) once the input has been closed, by
+           closeinput() or by the process, including in writers that were
+           blocked waiting for room.
         """
         if self._process.stdin is None:
             raise ValueError("Writing to process with stdin not a pipe")
-        self._lock.acquire()
-        self._pending_input.append(data)
-        self._inputsem.release()
-        self._lock.release()
+        if hasattr(data, 'fileno'):
+            size = 0    # Not held in memory
+        else:
+            data = byteView(data)
+            size = len(data)
+        self._input_cond.acquire()
+        try:
+            if self._quit:
+                raise IOError(errno.EPIPE, "Input of process is closed")
+            while (self._max_pending is not None and self._pending_bytes > 0
+                   and self._pending_bytes + size > self._max_pending):
+                if not block:
+                    raise InputBufferFull(self._pending_bytes, self._max_pending)
+                self._input_cond.wait()
+                if self._quit:
+                    raise IOError(errno.EPIPE, "Input of process is closed")
+            self._pending_input.append((data, size))
+            self._pending_bytes += size
+            self._input_cond.notify_all()
+        finally:
+            self._input_cond.release()
 
     def closeinput(self):
         """Close the standard input of a process, so it receives EOF.
         """
         self._lock.acquire()
         self._quit = True
-        self._inputsem.release()
+        self._input_cond.notify_all()
         self._lock.release()
 
 
@@ -794,14 +2373,14 @@ class ProcessManager(object):
         self.__last_id = 0
         self.__procs = {}
 
-    def start(self, args, executable=None, shell=False, cwd=None, env=None):
+    def start(self, args, executable=None, shell=False, cwd=None, env=None, max_pending=None):
         """Start a program in the background, collecting its output.
            Returns an integer identifying the process.        (Note that this
            integer is *not* the OS process id of the actuall running
-           process.)
+           process.)  See AsyncProcess for max_pending.
         """
         proc = AsyncProcess(args=args, executable=executable, shell=shell,
-                       cwd=cwd, env=env)
+                       cwd=cwd, env=env, max_pending=max_pending)
         self.__last_id += 1
         self.__procs[self.__last_id] = proc
         return self.__last_id
@@ -812,8 +2391,8 @@ class ProcessManager(object):
     def terminate(self, procid, graceperiod=1):
         return self.__procs[procid].terminate(graceperiod)
 
-    def write(self, procid, data):
-        return self.__procs[procid].write(data)
+    def write(self, procid, data, block=True):
+        return self.__procs[procid].write(data, block)
 
     def closeinput(self, procid):
         return self.__procs[procid].closeinput()
@@ -847,10 +2426,28 @@ class ProcessManager(object):
         self.wait(procid)
         del self.__procs[procid]
 
-    def reapall(self):
+    def terminateall(self, graceperiod=1):
+        """Terminate all processes concurrently, see terminate_all().
+           The processes remain available, as after wait().
+        """
+        terminate_all(self.__procs.values(), graceperiod)
+
+    def reapall(self, graceperiod=None):
         """Remove all processes.
-           Running processes are killed without pardon.
+           Running processes are killed without pardon, unless GRACEPERIOD
+           is given, in which case they are terminated with terminateall()
+           first.  Either way all processes are signalled at once rather
+           than one after another.
         """
+        if graceperiod is not None:
+            self.terminateall(graceperiod)
+        else:
+            for proc in self.__procs.values():
+                if proc.wait(os.WNOHANG) is None:
+                    try:
+                        proc.kill(signal.SIGKILL)
+                    except OSError:
+                        pass
         # Since reap() modifies __procs, we have to iterate over a copy
         # of the keys in it.  Thus, do not remove the .keys() call.
         for procid in self.__procs.keys():
@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from GitResultsManager import StagingSyncer, LineSuppressor, ProgressCollapser
+
+
+
+class StagingSyncerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.staging = os.path.join(self.tmpdir, 'staging')
+        self.dest = os.path.join(self.tmpdir, 'dest')
+        os.mkdir(self.staging)
+        os.mkdir(self.dest)
+        self.syncer = StagingSyncer(self.staging, self.dest, interval = 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writeStaged(self, contents, mode = 'w'):
+        with open(os.path.join(self.staging, 'results.json'), mode) as ff:
+            ff.write(contents)
+
+    def readDest(self):
+        with open(os.path.join(self.dest, 'results.json')) as ff:
+            return ff.read()
+
+    def test_append(self):
+        self.writeStaged('AAAA')
+        self.syncer.sync()
+        self.writeStaged('BBBB', 'a')
+        self.syncer.sync()
+        self.assertEqual(self.readDest(), 'AAAABBBB')
+
+    def test_rewrite_longer(self):
+        self.writeStaged('AAAA')
+        self.syncer.sync()
+        self.writeStaged('BBBBBBBB')
+        self.syncer.sync()
+        self.assertEqual(self.readDest(), 'BBBBBBBB')
+
+    def test_replace_longer(self):
+        self.writeStaged('AAAA')
+        self.syncer.sync()
+        # Written to a new file and renamed over the old one
+        tmpPath = os.path.join(self.staging, 'results.json.tmp')
+        with open(tmpPath, 'w') as ff:
+            ff.write('AAAACCCC')
+        os.rename(tmpPath, os.path.join(self.staging, 'results.json'))
+        self.syncer.sync()
+        self.assertEqual(self.readDest(), 'AAAACCCC')
+
+
+
+class LineSuppressorTest(unittest.TestCase):
+    def test_fold(self):
+        sup = LineSuppressor(foldRepeats = True)
+        out = sup.filter(['start'] + ['warning'] * 1000 + ['end'])
+        self.assertEqual(out, ['start', 'warning', '[last line repeated 999 times]', 'end'])
+        self.assertEqual((sup.nFolded, sup.nDropped), (999, 0))
+        self.assertEqual(sup.finish(), [])
+
+    def test_fold_numbers(self):
+        sup = LineSuppressor(normalizeNumbers = True)
+        out = sup.filter(['warning step %d' % ii for ii in range(1000)])
+        self.assertEqual(out, ['warning step 0'])
+        self.assertEqual(sup.finish(), ['[last line repeated 999 times]'])
+
+    def test_rate(self):
+        sup = LineSuppressor(foldRepeats = False, maxRate = 5)
+        out = sup.filter(['line %d' % ii for ii in range(20)])
+        self.assertEqual(out, ['line %d' % ii for ii in range(5)])
+        self.assertEqual((sup.nFolded, sup.nDropped), (0, 15))
+        self.assertEqual(sup.finish(), ['[15 lines dropped, over 5 lines per second]'])
+
+    def test_fold_and_rate(self):
+        sup = LineSuppressor(normalizeNumbers = True, maxRate = 5)
+        out = sup.filter(['warning step %d' % ii for ii in range(1000)])
+        self.assertEqual(out, ['warning step 0'])
+        self.assertEqual((sup.nFolded, sup.nDropped), (999, 0))
+
+    def test_fold_dropped_line(self):
+        sup = LineSuppressor(foldRepeats = True, maxRate = 2)
+        out = sup.filter(['a', 'b', 'c', 'c', 'c', 'd'])
+        # c and d are over the budget, but the folded run still says what c was
+        self.assertEqual(out, ['a', 'b', '[line repeated 2 times: c]'])
+        self.assertEqual(sup.finish(), ['[2 lines dropped, over 2 lines per second]'])
+        self.assertEqual((sup.nFolded, sup.nDropped), (2, 2))
+
+
+
+class ProgressCollapserTest(unittest.TestCase):
+    def test_leading_cr(self):
+        col = ProgressCollapser()
+        self.assertEqual(col.feed('\r10%'), [])
+        self.assertEqual(col.feed('\r100%'), [])
+        self.assertEqual(col.takePartial(includeProgress = False), None)
+        self.assertEqual(col.feed('\n'), ['100%'])
+        self.assertTrue(col.isEmpty())
+
+    def test_trailing_cr_flush(self):
+        col = ProgressCollapser()
+        self.assertEqual(col.feed('done\r'), [])
+        # The '\n' may still follow, so an intermediate flush keeps it back
+        self.assertEqual(col.takePartial(includeProgress = False), None)
+        self.assertEqual(col.takePartial(includeProgress = True), 'done')
+        self.assertTrue(col.isEmpty())
+
+    def test_crlf_split(self):
+        col = ProgressCollapser()
+        self.assertEqual(col.feed('one\r'), [])
+        self.assertEqual(col.takePartial(includeProgress = False), None)
+        self.assertEqual(col.feed('\ntwo\r'), ['one'])
+        self.assertEqual(col.feed('\n'), ['two'])
+        self.assertFalse(col.progress)
+        self.assertTrue(col.isEmpty())
+
+
+
+if __name__ == '__main__':
+    unittest.main()